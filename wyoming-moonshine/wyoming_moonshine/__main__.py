@@ -14,36 +14,66 @@ from __future__ import annotations
 import argparse
 import asyncio
 import logging
-import sys
-from typing import Any, Dict, Iterable, TypedDict
+import re
+import time
+from dataclasses import dataclass
+from types import MappingProxyType
+from typing import Any, Dict, Iterable, Mapping, TypedDict
 from urllib.parse import urlparse
 
+from moonshine_onnx import MoonshineOnnxModel
 from wyoming.server import AsyncTcpServer, AsyncUnixServer
 
-from .handler import MoonshineAsrHandler
+from .batching import TranscriptionBatcher
+from .handler import MoonshineAsrHandler, build_info_event
+from .model import Quantize, idle_seconds, load_model, run_dummy_inference
 
 
 class Profile(TypedDict):
     model: str
     language: str
     max_seconds: float
+    quantize: Quantize
 
 
+class _Defaults(TypedDict):
+    model: str
+    language: str
+    quantize: Quantize
+
+
+# Used when neither a flag nor a profile sets the value.
+_DEFAULTS: _Defaults = {
+    "model": "moonshine/tiny",
+    "language": "en",
+    "quantize": "fp32",
+}
+
+# Seconds without inference before the keepalive loop runs a dummy one.
+_IDLE_WARM_SECONDS = 30.0
+
 # Built-in profiles that tune model/language and simple limits.
 PROFILES: dict[str, Profile] = {
     "fast-en": {
         "model": "moonshine/tiny",
         "language": "en",
         "max_seconds": 15.0,
+        "quantize": "fp32",
     },
     "accurate-en": {
         "model": "moonshine/base",
         "language": "en",
         "max_seconds": 30.0,
+        "quantize": "fp32",
     },
 }
 
 
+# Numeric literals accepted by --moonshine-option (e.g. 3, -2, 0.5, .5, 1e-3).
+_INT_RE = re.compile(r"[-+]?\d+")
+_FLOAT_RE = re.compile(r"[-+]?(?:\d+\.\d*|\.\d+|\d+(?=[eE]))(?:[eE][-+]?\d+)?")
+
+
 def _parse_moonshine_options(pairs: Iterable[str]) -> Dict[str, Any]:
     """Parse KEY=VALUE pairs for --moonshine-option.
 
@@ -61,22 +91,132 @@ def _parse_moonshine_options(pairs: Iterable[str]) -> Dict[str, Any]:
             raise ValueError("Moonshine option key cannot be empty")
 
         lower = value.lower()
+        coerced: Any
         if lower in {"true", "false"}:
-            coerced: Any = lower == "true"
+            coerced = lower == "true"
+        elif _INT_RE.fullmatch(value):
+            coerced = int(value)
+        elif _FLOAT_RE.fullmatch(value):
+            coerced = float(value)
         else:
-            try:
-                coerced = int(value)
-            except ValueError:
-                try:
-                    coerced = float(value)
-                except ValueError:
-                    coerced = value
+            coerced = value
 
         options[key] = coerced
 
     return options
 
 
+@dataclass(slots=True, frozen=True)
+class Config:
+    """Server settings resolved once from the CLI flags and ``--profile``."""
+
+    uri: str
+    log_level: str
+    model_name: str
+    language: str
+    quantize: Quantize
+    max_seconds: float | None
+    ep: str
+    intra_op_threads: int | None
+    inter_op_threads: int | None
+    spin_threads: bool
+    pin_threads: bool
+    batch_size: int
+    batch_window: float
+    partial_interval: float | None
+    idle_warm: bool
+    moonshine_options: Mapping[str, Any]
+
+    @classmethod
+    def from_args(cls, args: argparse.Namespace) -> Config:
+        """Merge explicit flags over the profile (or built-in) defaults."""
+
+        defaults: Profile | _Defaults = _DEFAULTS
+        max_seconds: float | None = None
+
+        if args.profile:
+            profile = PROFILES.get(args.profile)
+            if profile is None:
+                known_profiles = ", ".join(sorted(PROFILES))
+                raise ValueError(
+                    f"Unknown profile {args.profile!r}. "
+                    f"Known profiles: {known_profiles}"
+                )
+
+            defaults = profile
+            max_seconds = profile["max_seconds"]
+
+        # --model/--language/--quantize default to SUPPRESS, so they are
+        # only present on ``args`` when given explicitly.
+        return cls(
+            uri=args.uri,
+            log_level=args.log_level,
+            model_name=getattr(args, "model", defaults["model"]),
+            language=getattr(args, "language", defaults["language"]),
+            quantize=getattr(args, "quantize", defaults["quantize"]),
+            max_seconds=max_seconds,
+            ep=args.ep,
+            intra_op_threads=args.intra_op_threads,
+            inter_op_threads=args.inter_op_threads,
+            spin_threads=not args.no_thread_spinning,
+            pin_threads=args.pin_threads,
+            batch_size=args.batch_size,
+            batch_window=args.batch_window_ms / 1000.0,
+            partial_interval=(
+                args.partial_interval_ms / 1000.0
+                if args.partial_interval_ms > 0
+                else None
+            ),
+            idle_warm=not args.no_idle_warm,
+            moonshine_options=MappingProxyType(
+                _parse_moonshine_options(args.moonshine_option)
+            ),
+        )
+
+
+async def _warmup_moonshine_model(
+    model: MoonshineOnnxModel, logger: logging.Logger
+) -> None:
+    """Run one dummy inference so the first real request is not a cold start.
+
+    ONNX Runtime allocates its arenas and plans memory on the first
+    ``session.run``; doing that here in a worker thread overlaps it with
+    the server accepting connections.
+    """
+
+    start = time.monotonic()
+    try:
+        await asyncio.to_thread(run_dummy_inference, model)
+    except Exception:
+        logger.exception("Moonshine warmup failed")
+        return
+
+    logger.info("Moonshine warmup finished in %.2fs", time.monotonic() - start)
+
+
+async def _keepalive_loop(
+    model: MoonshineOnnxModel, logger: logging.Logger, idle_s: float
+) -> None:
+    """Keep ONNX Runtime warm between sparse voice commands.
+
+    After long idle periods the first inference is much slower than a warm
+    one, so a tiny dummy inference runs whenever nothing has been
+    transcribed for ``idle_s`` seconds.
+    """
+
+    while True:
+        await asyncio.sleep(idle_s)
+        if idle_seconds() < idle_s:
+            continue
+
+        try:
+            await asyncio.to_thread(run_dummy_inference, model, 0.25)
+        except Exception:
+            logger.exception("Moonshine idle warm inference failed")
+        else:
+            logger.debug("Ran idle warm inference")
+
+
 def _parse_args() -> argparse.Namespace:
     parser = argparse.ArgumentParser(
         description="Wyoming protocol server for Moonshine ONNX speech recognition.",
@@ -87,18 +227,24 @@ def _parse_args() -> argparse.Namespace:
         default="tcp://0.0.0.0:10300",
         help="Wyoming server URI, e.g. tcp://0.0.0.0:10300",
     )
+    # --model/--language/--quantize default to SUPPRESS so that only flags
+    # actually given on the command line appear on the namespace and can
+    # override a --profile (this also covers the --flag=VALUE form).
     parser.add_argument(
         "--model",
-        default="moonshine/tiny",
+        default=argparse.SUPPRESS,
         help=(
             "Moonshine model name, e.g. moonshine/tiny, moonshine/base, "
-            "moonshine/tiny-ko, ..."
+            f"moonshine/tiny-ko, ... (default: {_DEFAULTS['model']})"
         ),
     )
     parser.add_argument(
         "--language",
-        default="en",
-        help="Language code reported to clients (e.g. en, en-US, ko)",
+        default=argparse.SUPPRESS,
+        help=(
+            "Language code reported to clients (e.g. en, en-US, ko) "
+            f"(default: {_DEFAULTS['language']})"
+        ),
     )
     parser.add_argument(
         "--log-level",
@@ -110,7 +256,85 @@ def _parse_args() -> argparse.Namespace:
         default=None,
         help=(
             "Named profile that sets model/language and simple limits, e.g. "
-            "fast-en or accurate-en. Explicit --model/--language override the profile."
+            "fast-en or accurate-en. Explicit --model/--language/--quantize "
+            "override the profile."
+        ),
+    )
+    parser.add_argument(
+        "--quantize",
+        choices=["fp32", "int8"],
+        default=argparse.SUPPRESS,
+        help=(
+            "Model weight precision. int8 dynamically quantizes the ONNX models "
+            "once (cached under ~/.cache/moonshine) for faster CPU inference "
+            f"(default: {_DEFAULTS['quantize']})."
+        ),
+    )
+    parser.add_argument(
+        "--ep",
+        default="auto",
+        help=(
+            "ONNX Runtime execution provider, e.g. OpenVINOExecutionProvider. "
+            "'auto' picks the best of OpenVINO, oneDNN and CPU available in "
+            "the installed onnxruntime (default: auto)"
+        ),
+    )
+    parser.add_argument(
+        "--intra-op-threads",
+        type=int,
+        default=None,
+        help=("ONNX Runtime intra-op thread count (default: number of usable CPUs)"),
+    )
+    parser.add_argument(
+        "--inter-op-threads",
+        type=int,
+        default=None,
+        help="ONNX Runtime inter-op thread count (default: ONNX Runtime's choice)",
+    )
+    parser.add_argument(
+        "--no-thread-spinning",
+        action="store_true",
+        help=(
+            "Let ONNX Runtime park idle pool threads instead of spinning; "
+            "saves CPU between requests at the cost of wake-up latency"
+        ),
+    )
+    parser.add_argument(
+        "--pin-threads",
+        action="store_true",
+        help="Pin each ONNX Runtime intra-op thread to its own CPU",
+    )
+    parser.add_argument(
+        "--batch-size",
+        type=int,
+        default=1,
+        help=(
+            "Transcribe up to this many concurrent utterances in one batched "
+            "model call; 1 disables batching (default: 1)"
+        ),
+    )
+    parser.add_argument(
+        "--batch-window-ms",
+        type=float,
+        default=5.0,
+        help="How long to wait for more utterances to join a batch (default: 5)",
+    )
+    parser.add_argument(
+        "--partial-interval-ms",
+        type=float,
+        default=0.0,
+        help=(
+            "Re-transcribe the audio received so far every this many "
+            "milliseconds of audio, so the transcript is ready when the "
+            "speaker stops; 0 disables (default: 0)"
+        ),
+    )
+    parser.add_argument(
+        "--no-idle-warm",
+        action="store_true",
+        help=(
+            "Disable the dummy inference run after "
+            f"{_IDLE_WARM_SECONDS:g}s of idleness to keep the model warm."
         ),
     )
     parser.add_argument(
@@ -128,50 +352,16 @@ def _parse_args() -> argparse.Namespace:
 
 
 async def _async_main() -> None:
-    args = _parse_args()
+    config = Config.from_args(_parse_args())
 
     logging.basicConfig(
-        level=getattr(logging, args.log_level.upper(), logging.INFO),
+        level=getattr(logging, config.log_level.upper(), logging.INFO),
         format="%(asctime)s [%(levelname)s] %(name)s: %(message)s",
     )
 
     logger = logging.getLogger(__name__)
 
-    # Resolve profile-based defaults.
-    model_name = args.model
-    language = args.language
-    max_seconds: float | None = None
-
-    if args.profile:
-        profile = PROFILES.get(args.profile)
-        if profile is None:
-            known_profiles = ", ".join(sorted(PROFILES))
-            raise ValueError(
-                f"Unknown profile {args.profile!r}. Known profiles: {known_profiles}"
-            )
-
-        # Explicit CLI flags win over profile defaults.
-        if "--model" not in sys.argv:
-            model_name = profile["model"]
-        if "--language" not in sys.argv:
-            language = profile["language"]
-        max_seconds = profile["max_seconds"]
-
-    moonshine_options = _parse_moonshine_options(args.moonshine_option)
-
-    # Factory to create a new handler per connection.
-    # Wyoming 1.8 calls this as handler_factory(reader, writer).
-    def handler_factory(reader, writer) -> MoonshineAsrHandler:
-        return MoonshineAsrHandler(
-            reader,
-            writer,
-            model_name,
-            language,
-            max_seconds=max_seconds,
-            moonshine_options=moonshine_options,
-        )
-
-    parsed = urlparse(args.uri)
+    parsed = urlparse(config.uri)
 
     if parsed.scheme == "tcp":
         host = parsed.hostname or "0.0.0.0"
@@ -180,26 +370,103 @@ async def _async_main() -> None:
         bind_desc = f"tcp://{host}:{port}"
     elif parsed.scheme == "unix":
         if not parsed.path:
-            raise ValueError(f"UNIX URI must have a path: {args.uri}")
+            raise ValueError(f"UNIX URI must have a path: {config.uri}")
         server = AsyncUnixServer(parsed.path)
         bind_desc = f"unix://{parsed.path}"
     else:
         raise ValueError(
-            f"Unsupported URI scheme in {args.uri!r} (expected tcp:// or unix://)"
+            f"Unsupported URI scheme in {config.uri!r} (expected tcp:// or unix://)"
+        )
+
+    # Load the ONNX sessions once, in the background so the listener is up
+    # (and answers ``describe``) meanwhile. Every connection shares the
+    # same model; transcriptions wait for it to finish loading.
+    model_task = asyncio.create_task(
+        asyncio.to_thread(
+            load_model,
+            config.model_name,
+            intra_op_threads=config.intra_op_threads,
+            inter_op_threads=config.inter_op_threads,
+            spin_threads=config.spin_threads,
+            pin_threads=config.pin_threads,
+            quantize=config.quantize,
+            ep=config.ep,
+        )
+    )
+
+    info_event = build_info_event(config.model_name, config.language)
+
+    batcher: TranscriptionBatcher | None = None
+    if config.batch_size > 1:
+        batcher = TranscriptionBatcher(
+            model_task, config.batch_size, window_seconds=config.batch_window
+        )
+
+    # Factory to create a new handler per connection.
+    # Wyoming 1.8 calls this as handler_factory(reader, writer).
+    def handler_factory(reader, writer) -> MoonshineAsrHandler:
+        return MoonshineAsrHandler(
+            reader,
+            writer,
+            config.model_name,
+            config.language,
+            model=model_task,
+            info_event=info_event,
+            batcher=batcher,
+            max_seconds=config.max_seconds,
+            partial_interval=config.partial_interval,
+            moonshine_options=dict(config.moonshine_options),
         )
 
     logger.info(
         "Starting Moonshine Wyoming ASR server on %s with model %s (language=%s)",
         bind_desc,
-        model_name,
-        language,
+        config.model_name,
+        config.language,
     )
 
-    await server.run(handler_factory)
+    server_task = asyncio.create_task(server.run(handler_factory))
+    background_tasks = [server_task, model_task]
+    try:
+        # Stop early if the listener fails to bind while the model loads.
+        await asyncio.wait(
+            (server_task, model_task), return_when=asyncio.FIRST_COMPLETED
+        )
+        if server_task.done():
+            server_task.result()
+            return
+
+        model = model_task.result()
+
+        # Connections arriving during warmup simply share the (thread-safe)
+        # sessions.
+        background_tasks.append(
+            asyncio.create_task(_warmup_moonshine_model(model, logger))
+        )
+        if batcher is not None:
+            background_tasks.append(asyncio.create_task(batcher.run()))
+        if config.idle_warm:
+            background_tasks.append(
+                asyncio.create_task(
+                    _keepalive_loop(model, logger, idle_s=_IDLE_WARM_SECONDS)
+                )
+            )
+
+        await server_task
+    finally:
+        for task in background_tasks:
+            task.cancel()
 
 
 def main() -> None:
-    asyncio.run(_async_main())
+    # uvloop's libuv-based loop handles the stream of small audio-chunk
+    # reads/writes with less overhead; fall back to asyncio's default loop.
+    try:
+        import uvloop
+    except ImportError:
+        asyncio.run(_async_main())
+    else:
+        uvloop.run(_async_main())
 
 
 if __name__ == "__main__":  # pragma: no cover
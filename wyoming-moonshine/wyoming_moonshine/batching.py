@@ -0,0 +1,103 @@
+"""Coalesce concurrent transcriptions into batched ONNX Runtime calls.
+
+When several satellites finish speaking at nearly the same time, each
+connection would otherwise run its own encoder/decoder passes and contend
+for the same intra-op thread pool. ``TranscriptionBatcher`` collects the
+requests that arrive within a short window and decodes them together.
+"""
+
+from __future__ import annotations
+
+import asyncio
+import logging
+from typing import List, Tuple
+
+import numpy as np
+from moonshine_onnx import MoonshineOnnxModel
+
+from .model import batch_groups, transcribe_batch
+
+_LOGGER = logging.getLogger(__name__)
+
+
+class TranscriptionBatcher:
+    """Single consumer that transcribes queued clips in batches.
+
+    ``run`` must be running (as a task) for ``transcribe`` to complete;
+    queued clips wait until ``model`` has finished loading.
+    """
+
+    def __init__(
+        self,
+        model: asyncio.Future[MoonshineOnnxModel],
+        max_batch_size: int,
+        window_seconds: float = 0.005,
+    ) -> None:
+        self._model = model
+        self._max_batch_size = max_batch_size
+        self._window_seconds = window_seconds
+        self._queue: asyncio.Queue[Tuple[np.ndarray, asyncio.Future[str]]] = (
+            asyncio.Queue()
+        )
+
+    async def transcribe(self, audio: np.ndarray) -> str:
+        """Queue ``audio`` (float32, ``[1, samples]``) and wait for its text."""
+
+        future: asyncio.Future[str] = asyncio.get_running_loop().create_future()
+        await self._queue.put((audio, future))
+        return await future
+
+    async def run(self) -> None:
+        loop = asyncio.get_running_loop()
+
+        while True:
+            batch = [await self._queue.get()]
+            deadline = loop.time() + self._window_seconds
+            while len(batch) < self._max_batch_size:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+
+            await self._run_batch(batch)
+
+    async def _run_batch(
+        self, batch: List[Tuple[np.ndarray, asyncio.Future[str]]]
+    ) -> None:
+        try:
+            model = await asyncio.shield(self._model)
+        except Exception as err:
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(err)
+            return
+
+        # Clips that cannot share a pass (e.g. different lengths on graphs
+        # without attention masks) are decoded in parallel, not in turn.
+        groups = batch_groups(model, [audio for audio, _ in batch])
+        await asyncio.gather(
+            *(self._run_group(model, [batch[i] for i in rows]) for rows in groups)
+        )
+
+    async def _run_group(
+        self,
+        model: MoonshineOnnxModel,
+        batch: List[Tuple[np.ndarray, asyncio.Future[str]]],
+    ) -> None:
+        audios = [audio for audio, _ in batch]
+        _LOGGER.debug("Transcribing batch of %s", len(audios))
+
+        try:
+            texts = await asyncio.to_thread(transcribe_batch, model, audios)
+        except Exception as err:
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(err)
+            return
+
+        for (_, future), text in zip(batch, texts):
+            if not future.done():
+                future.set_result(text)
@@ -8,19 +8,72 @@ from __future__ import annotations
 
 import asyncio
 import logging
-import tempfile
-import wave
-from pathlib import Path
+import threading
 from typing import Any, Dict, Optional
 
-import moonshine_onnx
+import numpy as np
+from moonshine_onnx import MoonshineOnnxModel
 from wyoming.asr import Transcript
-from wyoming.audio import AudioChunk, AudioStart
+from wyoming.audio import AudioStart
 from wyoming.event import Event
 from wyoming.server import AsyncEventHandler
 
+from .batching import TranscriptionBatcher
+from .model import pcm_to_audio, transcribe_with_model
+
 _LOGGER = logging.getLogger(__name__)
 
+# Headroom on top of max_seconds of 16kHz/16-bit mono audio so the chunk
+# that crosses the limit still fits in the preallocated buffer.
+_BUFFER_SLACK_BYTES = 65536
+
+# A partial transcript is only reused at audio-stop if every sample it did
+# not see stays below this int16 peak (about -36 dBFS), i.e. the speaker had
+# already finished and the VAD was just waiting out the trailing silence.
+_SILENCE_PEAK = 500
+
+
+def _consume_outcome(task: asyncio.Task) -> None:
+    # Retrieve the result of a discarded task so asyncio does not log
+    # "Task exception was never retrieved".
+    if not task.cancelled():
+        task.exception()
+
+
+def build_info_event(model_name: str, language: str) -> Event:
+    """Build an ``info`` event describing our ASR service and model.
+
+    Home Assistant uses this response when discovering Wyoming services
+    and when you select a speech-to-text engine in an Assist pipeline. The
+    payload only depends on the configured model and language, so it is
+    built once and shared by every connection.
+    """
+
+    asr_program = {
+        "name": "moonshine-onnx",
+        "attribution": {
+            "name": "Moonshine AI",
+            "url": "https://github.com/moonshine-ai/moonshine",
+        },
+        "installed": True,
+        "description": "Moonshine ONNX speech recognition",
+        "models": [
+            {
+                "name": model_name,
+                "attribution": {
+                    "name": "Moonshine AI",
+                    "url": "https://github.com/moonshine-ai/moonshine",
+                },
+                "installed": True,
+                "description": model_name,
+                "languages": [language],
+                "version": model_name,
+            }
+        ],
+    }
+
+    return Event(type="info", data={"asr": [asr_program]})
+
 
 class MoonshineAsrHandler(AsyncEventHandler):
     """Handles Wyoming ASR events and runs Moonshine for transcription.
@@ -28,6 +81,20 @@ class MoonshineAsrHandler(AsyncEventHandler):
     A single handler instance is created per TCP connection.
     We buffer audio between ``audio-start`` and ``audio-stop`` events and
     send a single ``transcript`` event back with the recognized text.
+
+    ``model`` is the task (future) loading the ``MoonshineOnnxModel`` that
+    all connections share. The handler awaits it before each transcription,
+    so connections can arrive while the model is still loading; it never
+    loads a model itself. ``info_event`` defaults to one built from
+    ``model_name``/``language``. With a ``batcher``, utterances are
+    transcribed through it so that concurrent connections share ONNX
+    Runtime calls.
+
+    With ``partial_interval`` (seconds), the growing buffer is re-transcribed
+    in the background every ``partial_interval`` seconds of audio while the
+    client is still speaking. If the audio that arrives after the last
+    partial is silence, that partial is sent at ``audio-stop`` instead of
+    decoding the whole utterance again.
     """
 
     def __init__(
@@ -37,20 +104,55 @@ class MoonshineAsrHandler(AsyncEventHandler):
         model_name: str,
         language: Optional[str] = None,
         *,
+        model: asyncio.Future[MoonshineOnnxModel],
+        info_event: Optional[Event] = None,
+        batcher: Optional[TranscriptionBatcher] = None,
         max_seconds: Optional[float] = None,
+        partial_interval: Optional[float] = None,
         moonshine_options: Optional[Dict[str, Any]] = None,
     ) -> None:
         # AsyncEventHandler in wyoming 1.8 expects reader/writer.
         super().__init__(reader, writer)
         self.model_name = model_name
+        self._model = model
         self.language = language or "en"
+        self._info_event = info_event or build_info_event(
+            self.model_name, self.language
+        )
         self.max_seconds = max_seconds
+        self.partial_interval = partial_interval
+        self._batcher = batcher
         self._moonshine_options: Dict[str, Any] = moonshine_options or {}
 
-        self._audio_bytes = bytearray()
+        # Audio is copied into one buffer that is reused across utterances.
+        # With max_seconds it is preallocated to the largest accepted size;
+        # otherwise it grows by doubling.
+        capacity = _BUFFER_SLACK_BYTES
+        if max_seconds is not None:
+            capacity += int(max_seconds * 16000 * 2)
+
+        self._buf = bytearray(capacity)
+        self._buf_view = memoryview(self._buf)
+        self._buf_len = 0
+
+        # Reusable float32 scratch for the converted samples (16kHz mono).
+        self._f32 = np.empty(int((max_seconds or 30) * 16000), dtype=np.float32)
+
         self._audio_format: Optional[AudioStart] = None
+        self._bytes_per_second = 16000 * 2
+        self._max_bytes: Optional[int] = None
         self._too_long = False
 
+        # Background transcription of the first ``_partial_covered`` bytes
+        # of audio; at most one runs at a time.
+        self._partial_task: Optional[asyncio.Task[str]] = None
+        self._partial_covered = 0
+        self._partial_step: Optional[int] = None
+        self._next_partial = 0
+
+    async def disconnect(self) -> None:
+        self._discard_partial()
+
     async def handle_event(self, event: Event) -> bool:
         """Main event loop for a single Wyoming connection.
 
@@ -71,9 +173,10 @@ class MoonshineAsrHandler(AsyncEventHandler):
         if event.type == "transcribe":
             # We currently ignore requested name/language and always use the
             # configured model. This can be extended later.
-            self._audio_bytes.clear()
+            self._buf_len = 0
             self._audio_format = None
             self._too_long = False
+            self._discard_partial()
             _LOGGER.debug("Received transcribe request: %s", event.data)
             return True
 
@@ -95,43 +198,59 @@ class MoonshineAsrHandler(AsyncEventHandler):
                 )
 
             self._audio_format = audio_start
-            self._audio_bytes.clear()
+            self._bytes_per_second = (
+                (audio_start.rate or 16000)
+                * (audio_start.width or 2)
+                * (audio_start.channels or 1)
+            )
+            self._max_bytes = (
+                int(self.max_seconds * self._bytes_per_second)
+                if self.max_seconds is not None
+                else None
+            )
+            self._partial_step = (
+                int(self.partial_interval * self._bytes_per_second)
+                if self.partial_interval
+                else None
+            )
+            self._next_partial = self._partial_step or 0
+            self._discard_partial()
+            self._buf_len = 0
             self._too_long = False
-            _LOGGER.debug("audio-start: resetting buffer")
+            if _LOGGER.isEnabledFor(logging.DEBUG):
+                _LOGGER.debug("audio-start: resetting buffer")
             return True
 
         if event.type == "audio-chunk":
             if self._audio_format is None:
-                _LOGGER.debug("audio-chunk before audio-start; ignoring")
+                if _LOGGER.isEnabledFor(logging.DEBUG):
+                    _LOGGER.debug("audio-chunk before audio-start; ignoring")
                 return True
 
             if self._too_long:
                 # Already over max_seconds; ignore additional audio.
                 return True
 
-            chunk = AudioChunk.from_event(event)
-            self._audio_bytes.extend(chunk.audio)
-
-            if self.max_seconds is not None and self._audio_format is not None:
-                rate = self._audio_format.rate or 16000
-                width = self._audio_format.width or 2
-                channels = self._audio_format.channels or 1
-                bytes_per_second = rate * width * channels
-                if bytes_per_second > 0:
-                    duration = len(self._audio_bytes) / bytes_per_second
-                    if duration > self.max_seconds:
-                        _LOGGER.warning(
-                            "Audio longer than max_seconds=%s (approx %.2fs); "
-                            "will return empty transcript.",
-                            self.max_seconds,
-                            duration,
-                        )
-                        self._too_long = True
+            # The PCM is the event's binary payload; skip building an
+            # AudioChunk just to read ``.audio`` on every chunk.
+            if event.payload:
+                self._append_audio(event.payload)
+
+            if self._max_bytes is not None and self._buf_len > self._max_bytes:
+                _LOGGER.warning(
+                    "Audio longer than max_seconds=%s (approx %.2fs); "
+                    "will return empty transcript.",
+                    self.max_seconds,
+                    self._buf_len / self._bytes_per_second,
+                )
+                self._too_long = True
+            elif self._partial_step and self._buf_len >= self._next_partial:
+                self._maybe_start_partial()
 
             return True
 
         if event.type == "audio-stop":
-            if not self._audio_bytes or self._too_long:
+            if not self._buf_len or self._too_long:
                 if self._too_long:
                     _LOGGER.debug(
                         "audio-stop with over-long audio; sending empty transcript"
@@ -144,18 +263,21 @@ class MoonshineAsrHandler(AsyncEventHandler):
                 await self.write_event(
                     Transcript(text="", language=self.language).event()
                 )
-                self._audio_bytes.clear()
+                self._buf_len = 0
                 self._too_long = False
+                self._discard_partial()
                 return True
 
-            text = await self._run_transcription()
+            text = await self._take_partial()
+            if text is None:
+                text = await self._run_transcription()
             _LOGGER.info("Transcript: %s", text)
 
             transcript_event = Transcript(text=text, language=self.language).event()
             await self.write_event(transcript_event)
 
             # Clear for next utterance on same connection
-            self._audio_bytes.clear()
+            self._buf_len = 0
             self._too_long = False
             return True
 
@@ -166,43 +288,150 @@ class MoonshineAsrHandler(AsyncEventHandler):
     # Internal helpers
     # ------------------------------------------------------------------
 
-    def _build_info_event(self) -> Event:
-        """Build an ``info`` event describing our ASR service and model.
+    def _maybe_start_partial(self) -> None:
+        """Start a background transcription of the buffer unless one is running."""
+
+        assert self._audio_format is not None and self._partial_step
+
+        if self._partial_task is not None and not self._partial_task.done():
+            # Single-flight: the next chunk past the tick will retry.
+            return
+
+        # The previous partial is finished but superseded by this one.
+        self._discard_partial()
+
+        rate = self._audio_format.rate or 16000
+        width = self._audio_format.width or 2
+        channels = self._audio_format.channels or 1
+        covered = self._buf_len
+        # Copy, since the buffer keeps growing (and may be reallocated).
+        pcm_bytes = bytes(self._buf_view[:covered])
+
+        stop = threading.Event()
+
+        async def _partial() -> str:
+            model = await asyncio.shield(self._model)
+            try:
+                text = await asyncio.to_thread(
+                    self._transcribe_partial_sync,
+                    model,
+                    pcm_bytes,
+                    rate,
+                    width,
+                    channels,
+                    stop,
+                )
+            except asyncio.CancelledError:
+                # The worker thread cannot be interrupted; make it stop
+                # decoding at its next step.
+                stop.set()
+                raise
+
+            return text
+
+        self._partial_task = asyncio.create_task(_partial())
+        self._partial_covered = covered
+        self._next_partial = covered + self._partial_step
+
+    def _discard_partial(self) -> None:
+        """Cancel any in-flight partial and drop its outcome."""
+
+        task, self._partial_task = self._partial_task, None
+        if task is None:
+            return
+
+        if task.done():
+            _consume_outcome(task)
+        else:
+            task.cancel()
+            task.add_done_callback(_consume_outcome)
+
+    async def _take_partial(self) -> Optional[str]:
+        """Return the last partial transcript if it still holds for the buffer.
+
+        Moonshine has no incremental decoder, so a partial is only reusable
+        when the audio it missed is silence. That is checked first: an
+        unusable partial is discarded straight away and ``None`` is returned
+        so the caller transcribes the whole buffer. A usable in-flight
+        partial is awaited rather than raced by a full decode.
+        """
 
-        Home Assistant uses this response when discovering Wyoming services
-        and when you select a speech-to-text engine in an Assist pipeline.
+        if self._partial_task is None:
+            return None
+
+        covered = self._partial_covered
+        width = self._audio_format.width if self._audio_format else 2
+        if width != 2 or not self._is_silent_after(covered):
+            self._discard_partial()
+            return None
+
+        task, self._partial_task = self._partial_task, None
+        try:
+            text = await task
+        except Exception:
+            _LOGGER.exception("Partial transcription failed")
+            return None
+
+        _LOGGER.debug(
+            "Reusing partial transcript (%.2fs of %.2fs)",
+            covered / self._bytes_per_second,
+            self._buf_len / self._bytes_per_second,
+        )
+        return text
+
+    def _is_silent_after(self, offset: int) -> bool:
+        """Whether all buffered audio from byte ``offset`` on is near silence."""
+
+        if offset > self._buf_len:
+            return False
+
+        tail = np.frombuffer(bytes(self._buf_view[offset : self._buf_len]), "<i2")
+        return not tail.size or int(np.abs(tail.astype(np.int32)).max()) < _SILENCE_PEAK
+
+    def _transcribe_partial_sync(
+        self,
+        model: MoonshineOnnxModel,
+        pcm_bytes: bytes,
+        rate: int,
+        width: int,
+        channels: int,
+        stop: threading.Event,
+    ) -> str:
+        """Like ``_transcribe_sync`` but without the shared float32 scratch.
+
+        A partial can still be running when the final transcription starts,
+        so it converts into a fresh array. Decoding ends early once ``stop``
+        is set.
         """
 
-        asr_program = {
-            "name": "moonshine-onnx",
-            "attribution": {
-                "name": "Moonshine AI",
-                "url": "https://github.com/moonshine-ai/moonshine",
-            },
-            "installed": True,
-            "description": "Moonshine ONNX speech recognition",
-            "models": [
-                {
-                    "name": self.model_name,
-                    "attribution": {
-                        "name": "Moonshine AI",
-                        "url": "https://github.com/moonshine-ai/moonshine",
-                    },
-                    "installed": True,
-                    "description": self.model_name,
-                    "languages": [self.language],
-                    "version": self.model_name,
-                }
-            ],
-        }
-
-        return Event(type="info", data={"asr": [asr_program]})
+        if width != 2:
+            return ""
+
+        audio = pcm_to_audio(pcm_bytes, rate, channels)
+        return transcribe_with_model(model, audio, stop=stop)
+
+    def _append_audio(self, audio: bytes) -> None:
+        end = self._buf_len + len(audio)
+        if end > len(self._buf):
+            # The view must be released before the bytearray can be resized.
+            self._buf_view.release()
+            self._buf.extend(bytes(max(end, 2 * len(self._buf)) - len(self._buf)))
+            self._buf_view = memoryview(self._buf)
+
+        self._buf_view[self._buf_len : end] = audio
+        self._buf_len = end
+
+    def _build_info_event(self) -> Event:
+        """Return the ``info`` event describing our ASR service and model."""
+
+        return self._info_event
 
     async def _run_transcription(self) -> str:
         """Run Moonshine transcription in a worker thread.
 
         Moonshine's ONNX ``transcribe`` call is blocking, so we offload it
-        with ``asyncio.to_thread`` to avoid blocking the asyncio event loop.
+        with ``asyncio.to_thread`` (or hand it to the shared batcher) to
+        avoid blocking the asyncio event loop.
         """
 
         assert self._audio_format is not None
@@ -210,51 +439,65 @@ class MoonshineAsrHandler(AsyncEventHandler):
         rate = self._audio_format.rate or 16000
         width = self._audio_format.width or 2
         channels = self._audio_format.channels or 1
+        pcm_bytes = bytes(self._buf_view[: self._buf_len])
 
+        return await self._transcribe(pcm_bytes, rate, width, channels)
+
+    async def _transcribe(
+        self, pcm_bytes: bytes, rate: int, width: int, channels: int
+    ) -> str:
+        if self._batcher is not None:
+            audio = self._pcm_to_audio(pcm_bytes, rate, width, channels)
+            if audio is None:
+                return ""
+
+            return await self._batcher.transcribe(audio)
+
+        model = await asyncio.shield(self._model)
         return await asyncio.to_thread(
             self._transcribe_sync,
-            bytes(self._audio_bytes),
+            model,
+            pcm_bytes,
             rate,
             width,
             channels,
         )
 
     def _transcribe_sync(
-        self, pcm_bytes: bytes, rate: int, width: int, channels: int
+        self,
+        model: MoonshineOnnxModel,
+        pcm_bytes: bytes,
+        rate: int,
+        width: int,
+        channels: int,
     ) -> str:
-        """Synchronous part that writes a WAV file and calls Moonshine.
+        """Synchronous part that converts the PCM and calls Moonshine."""
 
-        Moonshine's ONNX API expects a path to an audio file:
+        audio = self._pcm_to_audio(pcm_bytes, rate, width, channels)
+        if audio is None:
+            return ""
 
-            >>> import moonshine_onnx as moonshine
-            >>> moonshine.transcribe(
-            ...     moonshine.ASSETS_DIR / "beckett.wav", "moonshine/tiny"
-            ... )
+        return transcribe_with_model(model, audio)
 
-        so we wrap the raw PCM from Wyoming into a temporary WAV file.
-        """
-
-        with tempfile.NamedTemporaryFile(suffix=".wav", delete=False) as tmp:
-            tmp_path = Path(tmp.name)
-
-            with wave.open(tmp, "wb") as wav_file:
-                wav_file.setnchannels(channels)
-                wav_file.setsampwidth(width)
-                wav_file.setframerate(rate)
-                wav_file.writeframes(pcm_bytes)
+    def _pcm_to_audio(
+        self, pcm_bytes: bytes, rate: int, width: int, channels: int
+    ) -> Optional[np.ndarray]:
+        """Convert Wyoming PCM to Moonshine's input, or ``None`` if unsupported.
 
-        try:
-            result = moonshine_onnx.transcribe(tmp_path, self.model_name)
-        finally:
-            try:
-                tmp_path.unlink()
-            except FileNotFoundError:
-                pass
+        ``MoonshineOnnxModel.generate`` takes a float32 numpy array of shape
+        ``[1, num_samples]``, so the raw PCM from Wyoming is converted in
+        memory rather than round-tripped through a WAV file.
+        """
 
-        if isinstance(result, list):
-            if not result:
-                return ""
+        if width != 2:
+            _LOGGER.warning(
+                "Unsupported sample width %s (expected 2); returning empty transcript.",
+                width,
+            )
+            return None
 
-            return str(result[0])
+        num_samples = len(pcm_bytes) // 2
+        if num_samples > len(self._f32):
+            self._f32 = np.empty(num_samples, dtype=np.float32)
 
-        return str(result)
+        return pcm_to_audio(pcm_bytes, rate, channels, out=self._f32)
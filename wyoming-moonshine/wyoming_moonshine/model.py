@@ -0,0 +1,594 @@
+"""Process-wide Moonshine ONNX model loading and inference helpers.
+
+``moonshine_onnx.transcribe(audio, "moonshine/tiny")`` builds a fresh
+``MoonshineOnnxModel`` (two ONNX Runtime sessions) and re-reads the tokenizer
+on every call. The server instead loads the model once at startup and shares
+it between all connections.
+"""
+
+from __future__ import annotations
+
+import hashlib
+import logging
+import os
+import threading
+import time
+from functools import lru_cache
+from pathlib import Path
+from typing import Any, Dict, List, Literal, Optional, Tuple
+
+import moonshine_onnx
+import numpy as np
+import onnxruntime as ort
+from moonshine_onnx import MoonshineOnnxModel
+
+_LOGGER = logging.getLogger(__name__)
+
+# Moonshine models support 0.1s to 64s of 16kHz audio per call.
+SAMPLE_RATE = 16000
+MIN_SAMPLES = int(0.1 * SAMPLE_RATE)
+MAX_SAMPLES = 64 * SAMPLE_RATE
+
+Quantize = Literal["fp32", "int8"]
+
+# Execution providers tried by ``--ep auto``, best first. The CPU provider
+# is always available and is kept last as the fallback.
+_AUTO_PROVIDERS = (
+    "OpenVINOExecutionProvider",
+    "DnnlExecutionProvider",
+    "CPUExecutionProvider",
+)
+_PROVIDER_OPTIONS: Dict[str, Dict[str, str]] = {
+    "OpenVINOExecutionProvider": {"device_type": "CPU"},
+}
+
+# Providers that keep tensors in device memory, mapped to the OrtValue
+# device type used to bind outputs there. Decoding on these goes through
+# IOBinding so the KV cache stays on the device between decoder steps. On
+# host-memory providers (CPU, OpenVINO, oneDNN) plain ``session.run`` is
+# already zero-copy and measured faster than IOBinding.
+_IOBINDING_DEVICES: Dict[str, str] = {
+    "CUDAExecutionProvider": "cuda",
+    "TensorrtExecutionProvider": "cuda",
+    "DmlExecutionProvider": "dml",
+}
+
+# time.monotonic() of the most recent inference on any shared model.
+_last_inference = time.monotonic()
+
+
+def idle_seconds() -> float:
+    """Seconds since the last inference (real or dummy) finished."""
+
+    return time.monotonic() - _last_inference
+
+
+def _mark_inference() -> None:
+    global _last_inference
+    _last_inference = time.monotonic()
+
+
+class TunedMoonshineOnnxModel(MoonshineOnnxModel):
+    """``MoonshineOnnxModel`` whose sessions are built with our SessionOptions.
+
+    The upstream constructor always creates default sessions, so this
+    mirrors it rather than calling it. ``generate`` is inherited unchanged
+    except on device-memory execution providers, where it decodes through
+    IOBinding.
+    """
+
+    def __init__(
+        self,
+        model_name: str,
+        session_options: ort.SessionOptions,
+        quantize: Quantize = "fp32",
+        providers: Optional[List[Tuple[str, Dict[str, str]]]] = None,
+    ) -> None:
+        # handle e.g., "moonshine/tiny" and "tiny"
+        model_name = model_name.split("/")[-1]
+
+        if "tiny" in model_name:
+            self.num_layers = 6
+            self.num_key_value_heads = 8
+            self.head_dim = 36
+        elif "base" in model_name:
+            self.num_layers = 8
+            self.num_key_value_heads = 8
+            self.head_dim = 52
+        else:
+            raise ValueError(f"Unknown model {model_name!r}")
+
+        encoder, decoder = self._load_weights_from_hf_hub(model_name, "float")
+        if quantize == "int8":
+            encoder = _int8_weights(model_name, encoder)
+            decoder = _int8_weights(model_name, decoder)
+
+        self.encoder = ort.InferenceSession(
+            encoder, session_options, providers=providers
+        )
+        self.decoder = ort.InferenceSession(
+            decoder, session_options, providers=providers
+        )
+
+        self.encoder_input_names = [x.name for x in self.encoder.get_inputs()]
+        self.decoder_input_names = [x.name for x in self.decoder.get_inputs()]
+
+        self.decoder_start_token_id = 1
+        self.eos_token_id = 2
+
+        self.io_device = _IOBINDING_DEVICES.get(self.decoder.get_providers()[0])
+
+    def generate(self, audio: np.ndarray, max_len: Optional[int] = None) -> Any:
+        "audio has to be a numpy array of shape [1, num_audio_samples]"
+        if self.io_device is None:
+            return super().generate(audio, max_len)
+
+        return _generate_batch(
+            self, audio, np.ones_like(audio, dtype=np.int64), max_len or 192
+        )
+
+
+def _quantized_cache_dir() -> Path:
+    cache_home = os.environ.get("XDG_CACHE_HOME") or Path.home() / ".cache"
+    return Path(cache_home) / "moonshine"
+
+
+def _int8_weights(model_name: str, src: str) -> str:
+    """Return a dynamically INT8-quantized copy of the ONNX file ``src``.
+
+    The quantized file is written once under ``$XDG_CACHE_HOME/moonshine``
+    and reused on later starts. Its name includes a digest of the resolved
+    source file (a content-addressed blob in the Hugging Face cache), so new
+    upstream weights are quantized again rather than served stale.
+    """
+
+    dst = (
+        _quantized_cache_dir()
+        / f"{model_name}.{Path(src).stem}.{_source_digest(src)}.int8.onnx"
+    )
+    if dst.exists():
+        return str(dst)
+
+    # onnxruntime.quantization needs the separate ``onnx`` package, which is
+    # only required for this opt-in path.
+    from onnxruntime.quantization import QuantType, quantize_dynamic
+
+    _LOGGER.info("Quantizing %s to INT8 (one-time): %s", src, dst)
+    dst.parent.mkdir(parents=True, exist_ok=True)
+    tmp = dst.with_name(dst.name + ".tmp")
+    # The merged decoder keeps all of its compute inside the
+    # ``If(use_cache_branch)`` branches, which are skipped without
+    # EnableSubgraph.
+    quantize_dynamic(
+        src,
+        tmp,
+        weight_type=QuantType.QInt8,
+        extra_options={"EnableSubgraph": True},
+    )
+    tmp.replace(dst)
+
+    return str(dst)
+
+
+def _source_digest(src: str) -> str:
+    path = Path(src).resolve()
+    stat = path.stat()
+    key = f"{path}:{stat.st_size}:{stat.st_mtime_ns}".encode()
+    return hashlib.blake2b(key, digest_size=6).hexdigest()
+
+
+def _usable_cpu_ids() -> List[int]:
+    # Respect CPU affinity (e.g. docker --cpuset-cpus) where the OS exposes it.
+    if hasattr(os, "sched_getaffinity"):
+        return sorted(os.sched_getaffinity(0))
+
+    return list(range(os.cpu_count() or 1))
+
+
+def _available_cpus() -> int:
+    return len(_usable_cpu_ids())
+
+
+def _thread_affinities(num_threads: int) -> Optional[str]:
+    """Return a ``session.intra_op_thread_affinities`` value, one CPU per thread.
+
+    ONNX Runtime pins the ``num_threads - 1`` pool threads (the calling
+    thread is not pinned, so it keeps the first CPU) and numbers logical
+    processors from 1. Returns ``None`` if there are not enough CPUs.
+    """
+
+    cpu_ids = _usable_cpu_ids()
+    if num_threads > len(cpu_ids):
+        return None
+
+    return ";".join(str(cpu_id + 1) for cpu_id in cpu_ids[1:num_threads])
+
+
+def build_session_options(
+    intra_op_threads: Optional[int] = None,
+    inter_op_threads: Optional[int] = None,
+    *,
+    spin_threads: bool = True,
+    pin_threads: bool = False,
+) -> ort.SessionOptions:
+    """Build the SessionOptions shared by the encoder and decoder sessions.
+
+    ``intra_op_threads`` defaults to the number of usable CPUs;
+    ``inter_op_threads`` is left to ONNX Runtime unless given.
+    ``spin_threads`` keeps pool threads busy-waiting between ops instead of
+    parking them, trading idle CPU for no wake-up latency; ``pin_threads``
+    binds each intra-op thread to its own CPU.
+    """
+
+    opts = ort.SessionOptions()
+    opts.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+    opts.enable_mem_pattern = True
+    opts.enable_cpu_mem_arena = True
+    opts.intra_op_num_threads = intra_op_threads or _available_cpus()
+    if inter_op_threads:
+        opts.inter_op_num_threads = inter_op_threads
+
+    spinning = "1" if spin_threads else "0"
+    opts.add_session_config_entry("session.intra_op.allow_spinning", spinning)
+    opts.add_session_config_entry("session.inter_op.allow_spinning", spinning)
+
+    # A single thread is the caller's own and has no pool threads to pin.
+    if pin_threads and opts.intra_op_num_threads > 1:
+        affinities = _thread_affinities(opts.intra_op_num_threads)
+        if affinities is None:
+            _LOGGER.warning(
+                "Not pinning %s intra-op threads: only %s usable CPUs",
+                opts.intra_op_num_threads,
+                _available_cpus(),
+            )
+        else:
+            opts.add_session_config_entry(
+                "session.intra_op_thread_affinities", affinities
+            )
+
+    return opts
+
+
+def select_providers(ep: str = "auto") -> List[Tuple[str, Dict[str, str]]]:
+    """Return the ``(provider, options)`` list to build sessions with.
+
+    ``ep`` is either ``auto`` (the best of OpenVINO, oneDNN and CPU that this
+    onnxruntime build offers) or an explicit provider name such as
+    ``OpenVINOExecutionProvider``.
+    """
+
+    available = ort.get_available_providers()
+    if ep == "auto":
+        names = [name for name in _AUTO_PROVIDERS if name in available]
+    elif ep in available:
+        names = [ep]
+    else:
+        raise ValueError(
+            f"Execution provider {ep!r} is not available in this onnxruntime "
+            f"build. Available providers: {', '.join(available)}"
+        )
+
+    if "CPUExecutionProvider" not in names:
+        names.append("CPUExecutionProvider")
+
+    return [(name, _PROVIDER_OPTIONS.get(name, {})) for name in names]
+
+
+def load_model(
+    model_name: str,
+    *,
+    intra_op_threads: Optional[int] = None,
+    inter_op_threads: Optional[int] = None,
+    quantize: Quantize = "fp32",
+    ep: str = "auto",
+    spin_threads: bool = True,
+    pin_threads: bool = False,
+) -> MoonshineOnnxModel:
+    """Load the encoder/decoder ONNX Runtime sessions for ``model_name``."""
+
+    opts = build_session_options(
+        intra_op_threads,
+        inter_op_threads,
+        spin_threads=spin_threads,
+        pin_threads=pin_threads,
+    )
+    providers = select_providers(ep)
+    _LOGGER.info(
+        "Loading Moonshine model %s (%s, providers=%s, intra_op_threads=%s, "
+        "inter_op_threads=%s)",
+        model_name,
+        quantize,
+        ",".join(name for name, _ in providers),
+        opts.intra_op_num_threads,
+        opts.inter_op_num_threads or "default",
+    )
+    return TunedMoonshineOnnxModel(model_name, opts, quantize, providers)
+
+
+def pcm_to_audio(
+    pcm_bytes: bytes,
+    rate: int,
+    channels: int,
+    out: Optional[np.ndarray] = None,
+) -> np.ndarray:
+    """Convert 16-bit PCM to the float32 ``[1, samples]`` array Moonshine expects.
+
+    Multi-channel audio is downmixed to mono and other sample rates are
+    resampled to 16kHz with ``librosa.resample``, the same (band-limited)
+    resampler ``librosa.load`` uses. If ``out`` (a 1-D float32 array) is large
+    enough, the samples are converted into it in place and the result is a
+    view of ``out``.
+    """
+
+    samples = np.frombuffer(pcm_bytes, dtype=np.int16, count=len(pcm_bytes) // 2)
+    if out is not None and len(out) >= len(samples):
+        audio = out[: len(samples)]
+        np.multiply(samples, np.float32(1 / 32768), out=audio, dtype=np.float32)
+    else:
+        audio = samples.astype(np.float32) / 32768.0
+
+    if channels > 1:
+        audio = audio[: len(audio) - len(audio) % channels]
+        audio = audio.reshape(-1, channels).mean(axis=1)
+
+    if rate != SAMPLE_RATE and len(audio) > 0:
+        # librosa is a dependency of moonshine_onnx, but slow to import, so
+        # only pay for it when a client actually sends another rate.
+        import librosa
+
+        audio = librosa.resample(audio, orig_sr=rate, target_sr=SAMPLE_RATE).astype(
+            np.float32, copy=False
+        )
+
+    return audio[np.newaxis, :]
+
+
+def run_dummy_inference(
+    model: MoonshineOnnxModel, seconds: float = 1.0, max_len: int = 4
+) -> None:
+    """Run ``model`` once on silence to prime ONNX Runtime's buffers.
+
+    A few decoder steps (``max_len``) are enough to exercise both decoder
+    branches; silence need not emit EOS quickly, so the default 192-step
+    limit would waste the CPU on every warmup.
+    """
+
+    model.generate(
+        np.zeros((1, int(seconds * SAMPLE_RATE)), dtype=np.float32), max_len=max_len
+    )
+    _mark_inference()
+
+
+@lru_cache(maxsize=1)
+def _load_tokenizer() -> Any:
+    return moonshine_onnx.load_tokenizer()
+
+
+class _SessionRunner:
+    """Runs encoder passes and decoder steps with plain ``session.run``."""
+
+    def __init__(self, model: MoonshineOnnxModel) -> None:
+        self.model = model
+
+    def encode(self, inputs: Dict[str, np.ndarray]) -> Any:
+        return self.model.encoder.run(None, inputs)[0]
+
+    def decode(self, inputs: Dict[str, Any]) -> Tuple[np.ndarray, List[Any]]:
+        logits, *present_key_values = self.model.decoder.run(None, inputs)
+        return logits, present_key_values
+
+
+class _IOBindingRunner(_SessionRunner):
+    """Runs through IOBinding, keeping tensors on ``device`` between steps.
+
+    The encoder output and each step's ``present.*`` tensors stay on the
+    device as ``OrtValue``s and are bound as the next step's inputs; only
+    the logits are copied back to the host.
+    """
+
+    def __init__(self, model: MoonshineOnnxModel, device: str) -> None:
+        super().__init__(model)
+        self.device = device
+        self._logits_name, *self._present_names = [
+            x.name for x in model.decoder.get_outputs()
+        ]
+
+    def encode(self, inputs: Dict[str, np.ndarray]) -> Any:
+        binding = self.model.encoder.io_binding()
+        for name, value in inputs.items():
+            binding.bind_cpu_input(name, value)
+        binding.bind_output(self.model.encoder.get_outputs()[0].name, self.device)
+        self.model.encoder.run_with_iobinding(binding)
+        return binding.get_outputs()[0]
+
+    def decode(self, inputs: Dict[str, Any]) -> Tuple[np.ndarray, List[Any]]:
+        binding = self.model.decoder.io_binding()
+        for name, value in inputs.items():
+            if isinstance(value, ort.OrtValue):
+                binding.bind_ortvalue_input(name, value)
+            else:
+                binding.bind_cpu_input(name, np.asarray(value))
+        binding.bind_output(self._logits_name, "cpu")
+        for name in self._present_names:
+            binding.bind_output(name, self.device)
+
+        self.model.decoder.run_with_iobinding(binding)
+        logits, *present_key_values = binding.get_outputs()
+        return logits.numpy(), present_key_values
+
+
+def _runner(model: MoonshineOnnxModel) -> _SessionRunner:
+    io_device = getattr(model, "io_device", None)
+    if io_device is None:
+        return _SessionRunner(model)
+
+    return _IOBindingRunner(model, io_device)
+
+
+def _generate_batch(
+    model: MoonshineOnnxModel,
+    audio: np.ndarray,
+    attention_mask: np.ndarray,
+    max_len: int = 192,
+    stop: Optional[threading.Event] = None,
+) -> List[List[int]]:
+    """Greedy-decode every row of ``audio`` (``[batch, samples]``) at once.
+
+    Mirrors ``MoonshineOnnxModel.generate``, which only handles a batch of
+    one, with per-row end-of-sequence tracking. Sessions are run through
+    IOBinding on device-memory execution providers. Setting ``stop`` ends
+    decoding after the current step.
+    """
+
+    runner = _runner(model)
+    batch_size = audio.shape[0]
+
+    encoder_inputs: Dict[str, np.ndarray] = {"input_values": audio}
+    if "attention_mask" in model.encoder_input_names:
+        encoder_inputs["attention_mask"] = attention_mask
+
+    last_hidden_state = runner.encode(encoder_inputs)
+
+    past_key_values: Dict[str, Any] = {
+        f"past_key_values.{i}.{a}.{b}": np.zeros(
+            (0, model.num_key_value_heads, 1, model.head_dim), dtype=np.float32
+        )
+        for i in range(model.num_layers)
+        for a in ("decoder", "encoder")
+        for b in ("key", "value")
+    }
+
+    tokens = [[model.decoder_start_token_id] for _ in range(batch_size)]
+    input_ids = np.full((batch_size, 1), model.decoder_start_token_id, np.int64)
+    finished = np.zeros(batch_size, dtype=bool)
+    for i in range(max_len):
+        use_cache_branch = i > 0
+        decoder_inputs = dict(
+            input_ids=input_ids,
+            encoder_hidden_states=last_hidden_state,
+            use_cache_branch=[use_cache_branch],
+            **past_key_values,
+        )
+
+        if "encoder_attention_mask" in model.decoder_input_names:
+            decoder_inputs["encoder_attention_mask"] = attention_mask
+
+        logits, present_key_values = runner.decode(decoder_inputs)
+        next_tokens = logits[:, -1].argmax(axis=-1)
+        for row in np.flatnonzero(~finished):
+            tokens[row].append(int(next_tokens[row]))
+
+        finished |= next_tokens == model.eos_token_id
+        if finished.all() or (stop is not None and stop.is_set()):
+            break
+
+        # Finished rows keep decoding (their output is discarded) so that
+        # the batch stays rectangular.
+        input_ids = next_tokens[:, np.newaxis].astype(np.int64)
+        for k, v in zip(past_key_values.keys(), present_key_values):
+            if not use_cache_branch or "decoder" in k:
+                past_key_values[k] = v
+
+    return tokens
+
+
+def transcribe_batch(model: MoonshineOnnxModel, audios: List[np.ndarray]) -> List[str]:
+    """Transcribe several ``[1, samples]`` clips with shared ``session.run`` calls.
+
+    If the encoder and decoder both take attention masks, clips are
+    zero-padded to the longest one and the padding is masked out. Otherwise
+    the padding would change the shorter clips' transcripts, so only clips
+    of exactly the same length are decoded together.
+    """
+
+    texts = [""] * len(audios)
+    for group in batch_groups(model, audios):
+        rows = [i for i in group if _supported_length(audios[i])]
+        if not rows:
+            continue
+
+        if len(rows) == 1:
+            texts[rows[0]] = transcribe_with_model(model, audios[rows[0]])
+            continue
+
+        lengths = [audios[i].shape[-1] for i in rows]
+        batch = np.zeros((len(rows), max(lengths)), dtype=np.float32)
+        attention_mask = np.zeros(batch.shape, dtype=np.int64)
+        for j, (i, length) in enumerate(zip(rows, lengths)):
+            batch[j, :length] = audios[i][0]
+            attention_mask[j, :length] = 1
+
+        tokens = _generate_batch(model, batch, attention_mask)
+        _mark_inference()
+        for i, text in zip(rows, _load_tokenizer().decode_batch(tokens)):
+            texts[i] = str(text)
+
+    return texts
+
+
+def batch_groups(
+    model: MoonshineOnnxModel, audios: List[np.ndarray]
+) -> List[List[int]]:
+    """Split ``audios`` into index groups that can share one batched pass.
+
+    That is all of them when the graphs mask padding, and otherwise clips
+    of identical length.
+    """
+
+    if _masks_padding(model):
+        return [list(range(len(audios)))] if audios else []
+
+    groups: Dict[int, List[int]] = {}
+    for i, audio in enumerate(audios):
+        groups.setdefault(audio.shape[-1], []).append(i)
+
+    return list(groups.values())
+
+
+def _masks_padding(model: MoonshineOnnxModel) -> bool:
+    return (
+        "attention_mask" in model.encoder_input_names
+        and "encoder_attention_mask" in model.decoder_input_names
+    )
+
+
+def _supported_length(audio: np.ndarray) -> bool:
+    num_samples = audio.shape[-1]
+    if MIN_SAMPLES < num_samples < MAX_SAMPLES:
+        return True
+
+    _LOGGER.debug(
+        "Audio length %.2fs outside supported range; skipping",
+        num_samples / SAMPLE_RATE,
+    )
+    return False
+
+
+def transcribe_with_model(
+    model: MoonshineOnnxModel,
+    audio: np.ndarray,
+    *,
+    stop: Optional[threading.Event] = None,
+) -> str:
+    """Transcribe ``audio`` (float32, shape ``[1, samples]``) with ``model``.
+
+    Clips outside the range Moonshine supports yield an empty transcript.
+    With ``stop``, decoding ends early (with a truncated transcript) once it
+    is set.
+    """
+
+    if not _supported_length(audio):
+        return ""
+
+    if stop is None:
+        tokens = model.generate(audio)
+    else:
+        tokens = _generate_batch(
+            model, audio, np.ones_like(audio, dtype=np.int64), stop=stop
+        )
+    _mark_inference()
+    result = _load_tokenizer().decode_batch(tokens)
+    if not result:
+        return ""
+
+    return str(result[0])